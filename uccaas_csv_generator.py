@@ -1,10 +1,11 @@
 import streamlit as st
-import pandas as pd
 import io
-import csv
 import re
+from itertools import chain
 from datetime import datetime, timedelta
 from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES
+from openpyxl.utils.cell import coordinate_to_tuple
 
 st.set_page_config(page_title="CTI Sheet -> Meta Import Files", page_icon="📄", layout="centered")
 st.title("📄 CTI Sheet -> Meta Import Files")
@@ -17,29 +18,48 @@ uploaded_file = st.file_uploader("Upload Excel file (.xlsx)", type=["xlsx"])
 def _norm(name: str) -> str:
     return "".join(name.lower().split())
 
-def get_sheet(wb, wanted: str):
-    wanted_norm = _norm(wanted)
-    for name in wb.sheetnames:
-        if _norm(name) == wanted_norm:
-            return wb[name]
-    raise KeyError(f"Worksheet '{wanted}' not found. Available: {wb.sheetnames}")
-
-def convert_template(template_name, region):
-    if pd.isna(template_name):
-        return ""
-    mapping = {
-        "UCaaS|Link Basic Auto-Attendant": "_AA_Easy",
-        "UCaaS|Link Premium Auto-Attendant": "_AA_Premium",
-        "UCaaS|Link Lite": "_Lite",
-        "UCaaS|Link Standard": "_STD",
-        "UCaaS|Link Complete": "_Complete",
-        "UCaaS|Link Complete (HIPPA)": "Complete_HIPPA",
-        "UCaaS|Link Complete (No Voicemail)": "_Complete_NoVM",
-        "UCaaS|Link Complete ContactCenter Agent": "_Complete",
-        "UCaaS|Link Complete ContactCenter Manager": "_Complete",
-    }
-    s = str(template_name).strip()
-    return f"{region}{mapping[s]}" if s in mapping else ""
+def sheet_index(wb) -> dict:
+    """Map normalized sheet name -> actual name (first sheet wins on a clash)."""
+    return {_norm(name): name for name in reversed(wb.sheetnames)}
+
+def read_sheet_rows(wb, index: dict, wanted: str, max_col=None, max_row=None) -> list:
+    """Read a sheet once into a list of value tuples.
+
+    max_row stops the read early; rows past the end of the sheet are not padded in.
+    """
+    name = index.get(_norm(wanted))
+    if name is None:
+        raise KeyError(f"Worksheet '{wanted}' not found. Available: {wb.sheetnames}")
+    ws = wb[name]
+    ws.reset_dimensions()  # the sheet's stored <dimension> can be wrong; read to the real end
+    return list(ws.iter_rows(max_col=max_col, max_row=max_row, values_only=True))
+
+def cell(rows, ref: str):
+    """Value at an A1-style reference (e.g. "C2") in cached rows; None outside the sheet."""
+    row, col = coordinate_to_tuple(ref)
+    try:
+        return rows[row - 1][col - 1]
+    except IndexError:
+        return None
+
+# CTI template name -> Meta template suffix (prefixed with the region, e.g. "CH_STD")
+TEMPLATE_SUFFIXES = {
+    "UCaaS|Link Basic Auto-Attendant": "_AA_Easy",
+    "UCaaS|Link Premium Auto-Attendant": "_AA_Premium",
+    "UCaaS|Link Lite": "_Lite",
+    "UCaaS|Link Standard": "_STD",
+    "UCaaS|Link Complete": "_Complete",
+    "UCaaS|Link Complete (HIPPA)": "Complete_HIPPA",
+    "UCaaS|Link Complete (No Voicemail)": "_Complete_NoVM",
+    "UCaaS|Link Complete ContactCenter Agent": "_Complete",
+    "UCaaS|Link Complete ContactCenter Manager": "_Complete",
+}
+
+# Account types (User details col H) imported as BG administrators
+ADMIN_TYPES = frozenset({"Location Admin", "Company Admin"})
+
+# Template values (User details col M) that get no subscriber row; "" = blank cell
+SKIP_TEMPLATES = frozenset({"None", "Reserve Number", "None | Reserve Number", ""})
 
 def mac_trusted_until_str():
     """4 weeks out at 11:59:59 pm, formatted m/d/yy h:mm:ss am (no leading apostrophe)."""
@@ -49,40 +69,95 @@ def mac_trusted_until_str():
     yy = dt.strftime("%y")
     return f"{dt.month}/{dt.day}/{yy} {h12}:{dt.minute:02d}:{dt.second:02d} {ampm}"
 
-def digits_only(v) -> str:
-    return re.sub(r"\D", "", str(v or ""))
-
-# ---------- Main ----------
+# Text that counts as an empty cell: "", Excel error values (cached as text when
+# reading with data_only=True) and pandas' default NA tokens, which read_excel
+# used to turn into NaN before the sheets were read with openpyxl directly.
+BLANK_TEXT = frozenset(ERROR_CODES) | frozenset({
+    "", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+})
 
-if uploaded_file:
-    # Read bytes once; reuse for openpyxl + pandas
-    file_bytes = uploaded_file.read()
-    wb = load_workbook(io.BytesIO(file_bytes), data_only=True)
+def _blank(v) -> bool:
+    """True for an empty cell: None, NaN (the only value not equal to itself) or BLANK_TEXT."""
+    if type(v) is str:
+        return v in BLANK_TEXT
+    return v is None or v != v
 
-    try:
-        user_details_ws = get_sheet(wb, "User details")
-        eng_ws          = get_sheet(wb, "Engineering")
-        call_flow_ws    = get_sheet(wb, "Call flow")
-    except KeyError as e:
-        st.error(str(e)); st.stop()
+def _s(v) -> str:
+    """Cell value as text: str passes through untouched, blanks become ""."""
+    if type(v) is str:
+        return "" if v in BLANK_TEXT else v
+    return "" if _blank(v) else str(v)
 
-    st.caption(f"✅ Found sheets: {wb.sheetnames}")
+_NON_DIGIT = re.compile(r"\D")
 
-    customer_name = (eng_ws["C2"].value or "").strip()
-    region = (eng_ws["C4"].value or "").strip()  # CH or LV
+def digits_only(v) -> str:
+    return _NON_DIGIT.sub("", str(v or ""))
+
+def _csv_field(v) -> str:
+    """One CSV field, quoted the way csv.QUOTE_MINIMAL would."""
+    s = "" if v is None else str(v)
+    if "," in s or '"' in s or "\n" in s or "\r" in s:
+        return '"' + s.replace('"', '""') + '"'
+    return s
+
+def csv_lines(rows, width: int):
+    """Yield each row as a CSV line (no terminator), padded with blanks to `width` columns.
+
+    Fields are almost always plain strings, so join first and only quote field
+    by field when the joined line has a comma, quote or newline of its own.
+    """
+    for row in rows:
+        try:
+            line = ",".join(row)
+        except TypeError:  # non-str field
+            line = None
+        if line is None or line.count(",") != len(row) - 1 or '"' in line or "\n" in line or "\r" in line:
+            line = ",".join(map(_csv_field, row))
+        yield line + "," * (width - max(len(row), 1))
+
+def parse_workbook(file_bytes: bytes):
+    """Read the CTI sheets, each in a single pass.
+
+    Returns (sheetnames, user_rows, eng_rows, call_flow_rows).
+    """
+    wb = load_workbook(io.BytesIO(file_bytes), data_only=True, read_only=True, keep_links=False)
+    try:
+        index = sheet_index(wb)
+        # Read-only worksheets stream from the xlsx, so pull each sheet once into
+        # value rows (padded to the last column used) instead of indexing cells.
+        user_rows      = read_sheet_rows(wb, index, "User details", max_col=15)  # A..O
+        eng_rows       = read_sheet_rows(wb, index, "Engineering", max_col=13)   # A..M
+        call_flow_rows = read_sheet_rows(wb, index, "Call flow", max_col=8, max_row=27)  # A17..H27 used
+        return wb.sheetnames, user_rows, eng_rows, call_flow_rows
+    finally:
+        wb.close()
+
+# ---------- Build ----------
+
+@st.cache_data(show_spinner=False, ttl=timedelta(hours=1))
+def build_outputs(file_bytes: bytes):
+    """Parse the upload and build the combined Meta import CSV.
+
+    Cached on the uploaded bytes, so reruns (e.g. clicking the download
+    button) skip parsing and row building entirely. The TTL keeps the
+    "MAC trusted until" date from going stale on a long-running server.
+    Returns (sheetnames, customer_name, region, combined_csv bytes), with
+    combined_csv None when User details has no rows to import.
+    """
+    sheetnames, user_rows, eng_rows, call_flow_rows = parse_workbook(file_bytes)
+
+    customer_name = (cell(eng_rows, "C2") or "").strip()
+    region = (cell(eng_rows, "C4") or "").strip()  # CH or LV
 
     # ---- BG LCC defaults (new locations) ----
-    lcc_default_1  = eng_ws["G10"].value or ""
-    lcc_default_2  = eng_ws["C11"].value or ""
-    lcc_default_3  = eng_ws["C12"].value or ""   # unchanged
-    lcc_default_15 = eng_ws["G12"].value or ""
-
-    st.success(f"Loaded file for **{customer_name}** (Region: {region})")
+    lcc_default_1  = cell(eng_rows, "G10") or ""
+    lcc_default_2  = cell(eng_rows, "C11") or ""
+    lcc_default_3  = cell(eng_rows, "C12") or ""   # unchanged
+    lcc_default_15 = cell(eng_rows, "G12") or ""
+    lcc_defaults = (str(lcc_default_1), str(lcc_default_2), str(lcc_default_3), str(lcc_default_15))
 
-    # DataFrames (for simple row addressing)
-    user_df = pd.read_excel(io.BytesIO(file_bytes), sheet_name=user_details_ws.title, header=None)
-
-    # Column indexes (0-based) for User details
+    # Column indexes (0-based) into user_rows for User details
     COL_NAME = 0       # A
     COL_PHONE = 1      # B
     COL_CALLING = 3    # D
@@ -98,112 +173,108 @@ if uploaded_file:
 
     START_ROW = 8  # Excel row 9
 
+    # Nothing to build if no user row has a phone number (e.g. a blank template)
+    if all(_blank(r[COL_PHONE]) for r in user_rows[START_ROW:]):
+        return sheetnames, customer_name, region, None
+
+    # Per-user lookups, resolved once for this region
+    TEMPLATE_MAP   = {k: f"{region}{v}" for k, v in TEMPLATE_SUFFIXES.items()}
+    AA_TEMPLATES   = frozenset({f"{region}_AA_Easy", f"{region}_AA_Premium"})
+    MAC_TRUSTED_UNTIL = mac_trusted_until_str()  # same expiry for every device in this file
+
     # ---- Build Engineering-based LCC maps ----
     # Subscriber LCCs: key = Engineering!B (directory number), values = D,E,F,G
     subs_lcc_map = {}
-    row = 17
-    while True:
-        key_val = eng_ws[f"B{row}"].value
+    for r in eng_rows[16:]:  # Excel row 17 onward
+        key_val = r[1]  # B
         if not key_val:
             break
         key = digits_only(key_val)
-        l1 = eng_ws[f"D{row}"].value or ""
-        l2 = eng_ws[f"E{row}"].value or ""
-        l3 = eng_ws[f"F{row}"].value or ""
-        l15 = eng_ws[f"G{row}"].value or ""
+        l1, l2, l3, l15 = (v or "" for v in r[3:7])  # D,E,F,G
         subs_lcc_map[key] = (str(l1), str(l2), str(l3), str(l15))
-        row += 1
 
     # MLHG Pilot LCCs: key = Engineering!B (pilot number), values = J,K,L,M
     pilot_lcc_map = {}
-    row = 17
-    while True:
-        key_val = eng_ws[f"H{row}"].value
+    for r in eng_rows[16:]:
+        key_val = r[7]  # H
         if not key_val:
             break
         key = digits_only(key_val)
-        l1 = eng_ws[f"J{row}"].value or ""
-        l2 = eng_ws[f"K{row}"].value or ""
-        l3 = eng_ws[f"L{row}"].value or ""
-        l15 = eng_ws[f"M{row}"].value or ""
+        l1, l2, l3, l15 = (v or "" for v in r[9:13])  # J,K,L,M
         pilot_lcc_map[key] = (str(l1), str(l2), str(l3), str(l15))
-        row += 1
 
     # =========================
     # Build BG (width=16)
     # =========================
     BG_COLS = 16
-    def pad_bg(values): return (values + [""] * max(0, BG_COLS - len(values)))[:BG_COLS]
     bg_template = f"{region} BG"
 
-    numbers = []
-    for cell in user_details_ws["B9":"B100"]:
-        for c in cell:
-            if c.value:
-                numbers.append(str(c.value).strip())
-    for cell in call_flow_ws["D17":"D27"]:
-        for c in cell:
-            if c.value:
-                numbers.append(str(c.value).strip())
-    numbers = [n for n in dict.fromkeys(numbers) if n]  # de-dupe, preserve order
-
-    departments, seen_depts = [], set()
-    for cell in user_details_ws["I9":"I100"]:
-        for c in cell:
-            if c.value:
-                d = str(c.value).strip()
-                if d and d not in seen_depts:
-                    seen_depts.add(d); departments.append(d)
+    # Call flow rows 17-27: (MLHG name B, distribution C, pilot number D, pilot VM H),
+    # shared by the BG numbers and both MLHG sections below
+    mlhg_defs = [(r[1], r[2], r[3], r[7]) for r in call_flow_rows[16:27]]
+
+    # Numbers (B9:B100) and departments (I9:I100) in one sweep; dict keys
+    # de-dupe while preserving first-seen order
+    numbers, departments = {}, {}
+    for r in user_rows[8:100]:
+        num, dept = r[1], r[8]
+        if num:
+            numbers[_s(num).strip()] = None
+        if dept:
+            departments[_s(dept).strip()] = None
+    for _, _, phone_number, _ in mlhg_defs:  # D17:D27
+        if phone_number:
+            numbers[_s(phone_number).strip()] = None
+    numbers.pop("", None); departments.pop("", None)  # whitespace-only cells
 
     bg_rows = []
-    bg_rows.append(pad_bg(["#"]))
-    bg_rows.append(pad_bg(["#"]))
-    bg_rows.append(pad_bg(["#"]))
-    bg_rows.append(pad_bg(["#Business Groups"]))
-    bg_rows.append(pad_bg(["Business Group"]))
-    bg_rows.append(pad_bg([
+    bg_rows.append(["#"])
+    bg_rows.append(["#"])
+    bg_rows.append(["#"])
+    bg_rows.append(["#Business Groups"])
+    bg_rows.append(["Business Group"])
+    bg_rows.append([
         "MetaSphere CFS","MetaSphere EAS","Business Group","Template","CFS Persistent Profile",
         "Local CNAM name","Music On Hold Service - Subscribed","Music On Hold Service - class of service",
         "Music On Hold Service - limit concurrent calls","Music On Hold Service - maximum concurrent calls",
         "Music On Hold Service - Service Level","Music On Hold Service - Application Server",
         "Line Class Code 1","Line Class Code 2","Line Class Code 3","Line Class Code 15",
-    ]))
-    bg_rows.append(pad_bg([
+    ])
+    bg_rows.append([
         "CommandLink","CommandLink_vEAS_LV",customer_name,bg_template,bg_template,"",
         "TRUE","0","", "16","Enhanced","EAS Voicemail",
-        str(lcc_default_1), str(lcc_default_2), str(lcc_default_3), str(lcc_default_15),
-    ]))
-    bg_rows.append(pad_bg([""]))
-    bg_rows.append(pad_bg([""]))
-    bg_rows.append(pad_bg(["#BG Number Blocks"]))
-    bg_rows.append(pad_bg(["Business Group Number Block"]))
-    bg_rows.append(pad_bg([
+        *lcc_defaults,
+    ])
+    bg_rows.append([""])
+    bg_rows.append([""])
+    bg_rows.append(["#BG Number Blocks"])
+    bg_rows.append(["Business Group Number Block"])
+    bg_rows.append([
         "MetaSphere CFS","Business Group","First Phone Number","Block size","CFS Subscriber Group",
-    ]))
+    ])
     for num in numbers:
-        bg_rows.append(pad_bg(["CommandLink",customer_name,num,"1","Standard Subscribers"]))
-    bg_rows.append(pad_bg([""]))
-    bg_rows.append(pad_bg([""]))
-    bg_rows.append(pad_bg([""]))
-    bg_rows.append(pad_bg(["Department"]))
-    bg_rows.append(pad_bg(["MetaSphere CFS","MetaSphere EAS","Business Group","Name"]))
+        bg_rows.append(["CommandLink",customer_name,num,"1","Standard Subscribers"])
+    bg_rows.append([""])
+    bg_rows.append([""])
+    bg_rows.append([""])
+    bg_rows.append(["Department"])
+    bg_rows.append(["MetaSphere CFS","MetaSphere EAS","Business Group","Name"])
     for dept in departments:
-        bg_rows.append(pad_bg(["CommandLink","CommandLink_vEAS_LV",customer_name,dept]))
+        bg_rows.append(["CommandLink","CommandLink_vEAS_LV",customer_name,dept])
 
     # =========================
     # Seats/Devices/Exts/MLHG
     # Subscribers: add 4 new LCC fields after "use local name ..."
     # =========================
     SEATS_COLS = 32  # 28 + 4 new LCC columns for subscribers
-    def pad27(values): return (values + [""] * max(0, SEATS_COLS - len(values)))[:SEATS_COLS]
 
     sub_rows = []
-    sub_rows.append(pad27(["#"]))
-    sub_rows.append(pad27(["#"]))
-    sub_rows.append(pad27(["#"]))
-    sub_rows.append(pad27(["#BG Subscriber"]))
-    sub_rows.append(pad27(["Subscriber"]))
-    sub_rows.append(pad27([
+    sub_rows.append(["#"])
+    sub_rows.append(["#"])
+    sub_rows.append(["#"])
+    sub_rows.append(["#BG Subscriber"])
+    sub_rows.append(["Subscriber"])
+    sub_rows.append([
         "MetaSphere CFS","MetaSphere EAS","Phone number","Template","Business Group (CFS)","Business Group (EAS)",
         "CFS Subscriber Group","Name (CFS)","Name (EAS)","PIN (CFS)","PIN (EAS)","EAS Preferred Language",
         "EAS Customer Group","EAS Password","Business Group Administration - account type (CFS)",
@@ -213,161 +284,186 @@ if uploaded_file:
         "Department (EAS)","Calling Name Delivery - use local name for intra-BG calls only",
         # NEW per-subscriber LCCs
         "Line Class Code 1","Line Class Code 2","Line Class Code 3","Line Class Code 15",
-    ]))
-
-    for i in range(START_ROW, len(user_df)):
-        name         = user_df.iloc[i, COL_NAME]
-        phone        = user_df.iloc[i, COL_PHONE]
-        calling      = user_df.iloc[i, COL_CALLING]
-        email        = user_df.iloc[i, COL_EMAIL]
-        account_type = user_df.iloc[i, COL_ACCT_TYPE]
-        department   = user_df.iloc[i, COL_DEPT]
-        tz_val       = user_df.iloc[i, COL_TZ]
-        template_raw = user_df.iloc[i, COL_TEMPLATE]
-
-        if pd.isna(phone) or str(template_raw).strip() in ["None", "Reserve Number", "None | Reserve Number"]:
+    ])
+
+    # One pass over the user rows fills the subscriber, managed-device and
+    # intercom sections and indexes MLHG membership (User details col O).
+    subscriber_rows, device_rows, intercom_rows = [], [], []
+    mlhg_members = {}  # MLHG name -> member phone numbers, in sheet order
+    for r in user_rows[START_ROW:]:
+        name         = r[COL_NAME]
+        phone        = r[COL_PHONE]
+        calling      = r[COL_CALLING]
+        ext          = r[COL_EXT]
+        email        = r[COL_EMAIL]
+        account_type = r[COL_ACCT_TYPE]
+        department   = r[COL_DEPT]
+        tz_val       = r[COL_TZ]
+        template_raw = r[COL_TEMPLATE]
+        mac          = r[COL_MAC]
+        mlhg         = r[COL_MLHG]
+
+        if _blank(phone):
             continue
+        phone_s = _s(phone)
+
+        mlhg_s = _s(mlhg).strip()
+        if mlhg_s:
+            mlhg_members.setdefault(mlhg_s, []).append(phone_s)
+
+        mac_s = _s(mac)
+        if mac_s.strip():
+            device_rows.append([
+                "CommandLink",customer_name,mac_s,"TRUE",phone_s,
+                MAC_TRUSTED_UNTIL,"2","Determined by Endpoint Pack","",
+            ])
+
+        ext_s = _s(ext)
+        if ext_s.strip():
+            intercom_rows.append([
+                "CommandLink","CommandLink_vEAS_LV",customer_name,ext_s,ext_s,phone_s,
+            ])
+
+        template_str = _s(template_raw).strip()
+        if template_str in SKIP_TEMPLATES:
+            continue
+
+        template = TEMPLATE_MAP.get(template_str, "")
+        is_aa = template in AA_TEMPLATES
 
-        template = convert_template(template_raw, region)
-        is_aa = template in [f"{region}_AA_Easy", f"{region}_AA_Premium"]
+        name_s = _s(name)
+        dept_s = _s(department)
 
         line_state_monitor     = "" if is_aa else "TRUE"
-        calling_name_delivery  = "" if is_aa else ("" if pd.isna(name) else str(name))
+        calling_name_delivery  = "" if is_aa else name_s
         intra_bg_calls         = "" if is_aa else "TRUE"
-        acct_value             = "Administrator" if str(account_type) in ["Location Admin","Company Admin"] else "Normal"
+        acct_value             = "Administrator" if account_type in ADMIN_TYPES else "Normal"
 
-        tz_cfs = "" if pd.isna(tz_val) else str(tz_val)
+        tz_cfs = _s(tz_val)
         tz_eas = tz_cfs
 
         # --- Per-subscriber LCCs:
         phone_key = digits_only(phone)
-        l1, l2, l3, l15 = subs_lcc_map.get(phone_key, (str(lcc_default_1), str(lcc_default_2), str(lcc_default_3), str(lcc_default_15)))
+        l1, l2, l3, l15 = subs_lcc_map.get(phone_key, lcc_defaults)
 
-        sub_rows.append(pad27([
+        subscriber_rows.append([
             "CommandLink","CommandLink_vEAS_LV",
-            str(phone),template,customer_name,customer_name,
+            phone_s,template,customer_name,customer_name,
             "Standard Subscribers",
-            "" if pd.isna(name) else str(name),
-            "" if pd.isna(name) else str(name),
+            name_s,
+            name_s,
             "","",
             "eng","defaultGroup","",
             acct_value,acct_value,
             line_state_monitor,calling_name_delivery,
-            "" if pd.isna(email) else str(email),
+            _s(email),
             tz_cfs,tz_eas,
-            "" if pd.isna(calling) else str(calling),
-            str(phone),str(phone),
-            "" if pd.isna(department) else str(department),
-            "" if pd.isna(department) else str(department),
+            _s(calling),
+            phone_s,phone_s,
+            dept_s,
+            dept_s,
             intra_bg_calls,
             # subscriber LCCs
             l1, l2, l3, l15,
-        ]))
+        ])
 
-    sub_rows.append(pad27([""]))  # spacer
+    sub_rows.extend(subscriber_rows)
+    sub_rows.append([""])  # spacer
 
     # Managed Device
-    sub_rows.append(pad27(["#Managed Device"]))
-    sub_rows.append(pad27(["Managed Device"]))
-    sub_rows.append(pad27([
+    sub_rows.append(["#Managed Device"])
+    sub_rows.append(["Managed Device"])
+    sub_rows.append([
         "MetaSphere CFS","Business Group","MAC address","Assigned to user","User directory number",
         "MAC trusted until","Device version","Device model","Description",
-    ]))
-    for i in range(START_ROW, len(user_df)):
-        phone = user_df.iloc[i, COL_PHONE]
-        mac   = user_df.iloc[i, COL_MAC]
-        if pd.isna(phone) or pd.isna(mac) or str(mac).strip() == "":
-            continue
-        sub_rows.append(pad27([
-            "CommandLink",customer_name,str(mac),"TRUE",str(phone),
-            mac_trusted_until_str(),"2","Determined by Endpoint Pack","",
-        ]))
+    ])
+    sub_rows.extend(device_rows)
 
     # Intercom Code Range
-    sub_rows.append(pad27([""])); sub_rows.append(pad27([""])); sub_rows.append(pad27([""]))
-    sub_rows.append(pad27(["#Intercom Code Range"]))
-    sub_rows.append(pad27(["Intercom Code Range"]))
-    sub_rows.append(pad27([
+    sub_rows.append([""]); sub_rows.append([""]); sub_rows.append([""])
+    sub_rows.append(["#Intercom Code Range"])
+    sub_rows.append(["Intercom Code Range"])
+    sub_rows.append([
         "MetaSphere CFS","MetaSphere EAS","Business Group","First Code","Last Code","First Directory Number",
-    ]))
-    for i in range(START_ROW, len(user_df)):
-        phone = user_df.iloc[i, COL_PHONE]
-        ext   = user_df.iloc[i, COL_EXT]
-        if pd.isna(phone) or pd.isna(ext) or str(ext).strip() == "":
-            continue
-        sub_rows.append(pad27([
-            "CommandLink","CommandLink_vEAS_LV",customer_name,str(ext),str(ext),str(phone),
-        ]))
+    ])
+    sub_rows.extend(intercom_rows)
 
     # MLHGs
-    sub_rows.append(pad27([""])); sub_rows.append(pad27([""])); sub_rows.append(pad27([""])); sub_rows.append(pad27([""]))
-    sub_rows.append(pad27(["#MLHGs"]))
-    sub_rows.append(pad27(["MLHG"]))
-    sub_rows.append(pad27([
+    sub_rows.append([""]); sub_rows.append([""]); sub_rows.append([""]); sub_rows.append([""])
+    sub_rows.append(["#MLHGs"])
+    sub_rows.append(["MLHG"])
+    sub_rows.append([
         "MetaSphere CFS","Business Group","MLHG Name",
         "Members;Directory number;Login/logout supported","Distribution algorithm","Hunt on no-answer",
-    ]))
-    for r in range(17, 28):
-        mlg_name = call_flow_ws[f"B{r}"].value
-        if not mlg_name:
+    ])
+    for mlg_name, dist_alg, _, _ in mlhg_defs:
+        if _blank(mlg_name):
             continue
-        dist_alg = call_flow_ws[f"C{r}"].value
-        dist_alg_clean = "" if pd.isna(dist_alg) else str(dist_alg).strip()
+        dist_alg_clean = _s(dist_alg).strip()
         if dist_alg_clean == "Ring All":
             dist_alg_clean = "Ring all"
-        members = []
-        for i in range(START_ROW, len(user_df)):
-            if str(user_df.iloc[i, COL_MLHG]).strip() == str(mlg_name).strip():
-                num = user_df.iloc[i, COL_PHONE]
-                if pd.notna(num):
-                    members.append(f"{{'{str(num)}';'FALSE'}}")
-        sub_rows.append(pad27([
-            "CommandLink",customer_name,str(mlg_name),";".join(members),dist_alg_clean,"FALSE",
-        ]))
+        # Members render as {'<number>';'FALSE'} separated by ";", built with one join
+        mlg_name = _s(mlg_name)
+        member_nums = mlhg_members.get(mlg_name.strip())
+        members = "{'" + "';'FALSE'};{'".join(member_nums) + "';'FALSE'}" if member_nums else ""
+        sub_rows.append([
+            "CommandLink",customer_name,mlg_name,members,dist_alg_clean,"FALSE",
+        ])
 
     # MLHG Pilot
-    sub_rows.append(pad27([""])); sub_rows.append(pad27([""]))
-    sub_rows.append(pad27(["#MLHG Pilot"]))
-    sub_rows.append(pad27(["MLHG Pilot Number"]))
-    sub_rows.append(pad27([
+    sub_rows.append([""]); sub_rows.append([""])
+    sub_rows.append(["#MLHG Pilot"])
+    sub_rows.append(["MLHG Pilot Number"])
+    sub_rows.append([
         "MetaSphere CFS","MetaSphere EAS","Business Group (CFS)","MLHG Name","Phone number",
         "Template","Name (EAS)","Name (CFS)","PIN (EAS)","EAS Password","EAS Customer Group",
         # NEW per-pilot LCCs (after EAS Customer Group)
         "Line Class Code 1","Line Class Code 2","Line Class Code 3","Line Class Code 15",
-    ]))
-    for r in range(17, 28):
-        mlg_name     = call_flow_ws[f"B{r}"].value
-        phone_number = call_flow_ws[f"D{r}"].value
-        pilot_vm     = call_flow_ws[f"H{r}"].value
-        if not mlg_name or not phone_number:
+    ])
+    for mlg_name, _, phone_number, pilot_vm in mlhg_defs:
+        if _blank(mlg_name) or _blank(phone_number):
             continue
-        pilot_template = f"{region}_MLHG_Pilot" if str(pilot_vm).strip().lower() == "yes" else f"{region}_MLHG_Pilot_NoVM"
+        pilot_template = f"{region}_MLHG_Pilot" if _s(pilot_vm).strip().lower() == "yes" else f"{region}_MLHG_Pilot_NoVM"
 
         phone_key = digits_only(phone_number)
-        pl1, pl2, pl3, pl15 = pilot_lcc_map.get(
-            phone_key,
-            (str(lcc_default_1), str(lcc_default_2), str(lcc_default_3), str(lcc_default_15))
-        )
+        pl1, pl2, pl3, pl15 = pilot_lcc_map.get(phone_key, lcc_defaults)
 
-        sub_rows.append(pad27([
+        sub_rows.append([
             "CommandLink","CommandLink_vEAS_LV",customer_name,
-            str(mlg_name),str(phone_number),pilot_template,
+            _s(mlg_name),_s(phone_number),pilot_template,
             f"{mlg_name} Pilot",f"{mlg_name} Pilot","*","*","defaultGroup",
             # pilot LCCs
             pl1, pl2, pl3, pl15,
-        ]))
+        ])
 
     # ---------- Single combined CSV (BG on top of Seats) ----------
-    combined_buffer = io.StringIO()
-    writer = csv.writer(combined_buffer, lineterminator="\n")
-    writer.writerows(bg_rows)
-    writer.writerow([])  # optional blank separator line
-    writer.writerows(sub_rows)
+    # Encoded once to bytes so the download doesn't need Streamlit's own .encode()
+    combined_csv = "\n".join(chain(
+        csv_lines(bg_rows, BG_COLS),
+        [""],  # optional blank separator line
+        csv_lines(sub_rows, SEATS_COLS),
+        [""],  # trailing newline
+    )).encode("utf-8")
+
+    return sheetnames, customer_name, region, combined_csv
+
+# ---------- Main ----------
+
+if uploaded_file:
+    try:
+        sheetnames, customer_name, region, combined_csv = build_outputs(uploaded_file.getvalue())
+    except KeyError as e:
+        st.error(str(e)); st.stop()
+
+    st.caption(f"✅ Found sheets: {sheetnames}")
+    if combined_csv is None:
+        st.warning("No user rows detected past row 9; nothing to generate."); st.stop()
+    st.success(f"Loaded file for **{customer_name}** (Region: {region})")
 
     combined_filename = f"{customer_name}-Meta-Import-Combined.csv"
     st.download_button(
         label=f"⬇️ Download {combined_filename}",
-        data=combined_buffer.getvalue(),
+        data=combined_csv,
         file_name=combined_filename,
         mime="text/csv",
     )